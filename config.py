@@ -5,13 +5,24 @@
 
 import os
 import json
+import queue
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
 from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, asdict
+import orjson
 from dotenv import load_dotenv
 
 # 加载环境变量
 load_dotenv()
 
+def _debug_log_default(obj: Any) -> Any:
+    """调试日志中 orjson 无法直接序列化的对象：Pydantic 模型转为字典，其余转为字符串"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return str(obj)
+
 @dataclass
 class ProviderConfig:
     """提供商配置"""
@@ -96,9 +107,21 @@ class ConfigManager:
             self.providers = PROVIDERS.copy()
             self.presets = MODEL_PRESETS.copy()
         
-        # 初始化调试日志（内存存储，退出时清空）
-        self.debug_logs = []
+        # 模型 -> 提供商索引，每次请求都会查询，避免逐个扫描提供商的模型列表
+        self._rebuild_model_index()
+        
+        # 初始化调试日志（内存环形缓冲区，退出时清空）
         self.max_debug_logs = 50  # 最大调试日志数量
+        self.debug_logs = deque(maxlen=self.max_debug_logs)
+        # 调试日志开关：关闭后请求路径上不再构建日志内容
+        self.debug_log_enabled = os.environ.get("CLAUDE_PROXY_DEBUG_LOGS", "true").lower() == "true"
+        # 调试日志文件（可选，NDJSON 格式）：由后台线程追加写入，请求路径只负责入队
+        self.debug_log_file = os.environ.get("CLAUDE_PROXY_DEBUG_LOG_FILE") or None
+        self._debug_log_queue = None
+        self._debug_log_writer_thread = None
+        self._debug_log_write_failed = threading.Event()  # 写入线程出错后置位，之后不再入队
+        if self.debug_log_file:
+            self._start_debug_log_writer()
         
         # 初始化对话记录功能（文件持久化，可选开关）
         self.conversation_recording_enabled = False  # 默认关闭
@@ -107,13 +130,20 @@ class ConfigManager:
         self.buffer_size = 10  # 每10条记录写入一次文件
         self.last_conversations = []  # 用于去重的最近对话记录
         
+        # 初始化响应缓存（精确匹配，LRU 淘汰，只缓存 temperature 为 0 的请求），默认关闭
+        self.max_cached_responses = 128
+        self.response_cache = OrderedDict()
+        
         # 初始化配置，尝试加载default预设
         self.current_config = {
             "proxy_enabled": True,
             "super_model": None,
             "big_model": None,
             "small_model": None,
-            "current_preset": None
+            "current_preset": None,
+            "response_cache_enabled": os.environ.get("CLAUDE_PROXY_RESPONSE_CACHE", "false").lower() == "true",
+            # 竞速模型（可选）：非流式请求同时发给主模型和该模型，采用先成功返回的结果
+            "race_model": os.environ.get("CLAUDE_PROXY_RACE_MODEL") or None
         }
         
         # 尝试自动加载default预设
@@ -147,12 +177,17 @@ class ConfigManager:
         """获取所有模型，按提供商分组"""
         return {name: provider.models for name, provider in self.providers.items()}
     
+    def _rebuild_model_index(self):
+        """重建模型到提供商的索引（修改 providers 后需调用）"""
+        self._model_provider_index = {}
+        for provider_name, provider in self.providers.items():
+            for model_name in provider.models:
+                # 同一模型出现在多个提供商时，保持原来的“第一个匹配”语义
+                self._model_provider_index.setdefault(model_name, provider_name)
+    
     def find_model_provider(self, model_name: str) -> Optional[str]:
         """找到模型属于哪个提供商"""
-        for provider_name, provider in self.providers.items():
-            if model_name in provider.models:
-                return provider_name
-        return None
+        return self._model_provider_index.get(model_name)
     
     def validate_model(self, model_name: str) -> (bool, str):
         """验证模型是否存在且提供商可用，返回 (bool, reason)"""
@@ -295,8 +330,9 @@ class ConfigManager:
             return False
     
     def add_debug_log(self, log_type: str, message: str, details: Optional[Dict[str, Any]] = None):
-        """添加调试日志"""
-        from datetime import datetime
+        """添加调试日志（O(1) 追加，超出上限时自动丢弃最旧的记录）"""
+        if not self.debug_log_enabled:
+            return
         log_entry = {
             "timestamp": datetime.now().isoformat(),
             "type": log_type,  # "request", "response", "error", "config", "model_switch"
@@ -304,14 +340,64 @@ class ConfigManager:
             "details": details or {}
         }
         self.debug_logs.append(log_entry)
-        
-        # 保持日志数量在限制内
-        if len(self.debug_logs) > self.max_debug_logs:
-            self.debug_logs = self.debug_logs[-self.max_debug_logs:]
+        log_queue = self._debug_log_queue
+        if log_queue is not None and not self._debug_log_write_failed.is_set():
+            # 在调用线程上序列化，写入线程只处理字节，不会与请求路径上对象的后续修改竞争
+            try:
+                log_queue.put(orjson.dumps(log_entry, default=_debug_log_default, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS))
+            except TypeError as e:
+                print(f"⚠️ 调试日志序列化失败: {e}")
+    
+    def _start_debug_log_writer(self):
+        """启动调试日志文件的后台写入线程"""
+        log_dir = os.path.dirname(self.debug_log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        self._debug_log_write_failed.clear()
+        self._debug_log_queue = queue.SimpleQueue()
+        self._debug_log_writer_thread = threading.Thread(
+            target=self._debug_log_writer, name="debug-log-writer", daemon=True
+        )
+        self._debug_log_writer_thread.start()
+    
+    def _debug_log_writer(self):
+        """后台线程：批量取出已序列化的 NDJSON 行并追加到文件（收到 None 时退出）"""
+        try:
+            with open(self.debug_log_file, 'ab') as f:
+                while True:
+                    batch = [self._debug_log_queue.get()]
+                    # 一次写入所有已排队的记录，减少 write/flush 次数
+                    while True:
+                        try:
+                            batch.append(self._debug_log_queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    
+                    stop = False
+                    for line in batch:
+                        if line is None:
+                            stop = True
+                            continue
+                        f.write(line)
+                    f.flush()
+                    if stop:
+                        return
+        except Exception as e:
+            print(f"❌ 写入调试日志文件失败: {e}")
+            self._debug_log_write_failed.set()
+    
+    def close_debug_log_file(self, timeout: float = 5.0):
+        """停止后台写入线程，确保排队中的日志写入文件"""
+        if self._debug_log_queue is None or self._debug_log_writer_thread is None:
+            return
+        self._debug_log_queue.put(None)
+        self._debug_log_writer_thread.join(timeout)
+        self._debug_log_queue = None
+        self._debug_log_writer_thread = None
     
     def get_debug_logs(self, log_type: Optional[str] = None, limit: Optional[int] = None):
         """获取调试日志"""
-        logs = self.debug_logs
+        logs = list(self.debug_logs)
         
         # 过滤日志类型
         if log_type:
@@ -325,7 +411,25 @@ class ConfigManager:
     
     def clear_debug_logs(self):
         """清空调试日志"""
-        self.debug_logs = []
+        self.debug_logs.clear()
+    
+    def get_cached_response(self, key: str) -> Optional[Any]:
+        """获取缓存的响应，命中时将其移到 LRU 队尾"""
+        response = self.response_cache.get(key)
+        if response is not None:
+            self.response_cache.move_to_end(key)
+        return response
+    
+    def cache_response(self, key: str, response: Any):
+        """缓存响应，超出上限时淘汰最久未使用的记录"""
+        self.response_cache[key] = response
+        self.response_cache.move_to_end(key)
+        if len(self.response_cache) > self.max_cached_responses:
+            self.response_cache.popitem(last=False)
+    
+    def clear_response_cache(self):
+        """清空响应缓存"""
+        self.response_cache.clear()
     
     def enable_conversation_recording(self, file_path: str) -> bool:
         """启用对话记录功能"""
@@ -1,18 +1,27 @@
 from fastapi import FastAPI, Request, HTTPException
 import uvicorn
 import logging
+import io
 import json
+import hashlib
+import orjson
+from collections import OrderedDict
+from functools import lru_cache
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Dict, Any, Optional, Union, Literal
 import httpx
 import os
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 import litellm
 import uuid
 import time
+import asyncio
 import re
 from datetime import datetime
+from contextlib import asynccontextmanager
 import sys
+import threading
 from config import config_manager as global_config
 
 # Configure logging
@@ -72,7 +81,44 @@ for handler in logger.handlers:
     if isinstance(handler, logging.StreamHandler):
         handler.setFormatter(ColorizedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
 
-app = FastAPI()
+class _Clock:
+    """Wall-clock seconds refreshed by a background task, for fields that only need 1s precision."""
+    cached = int(time.time())
+    ticking = False  # only True while _tick_clock runs (i.e. inside the app lifespan)
+
+    @classmethod
+    def now(cls) -> int:
+        return cls.cached if cls.ticking else int(time.time())
+
+async def _tick_clock():
+    _Clock.ticking = True
+    try:
+        while True:
+            _Clock.cached = int(time.time())
+            await asyncio.sleep(0.5)
+    finally:
+        _Clock.ticking = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    clock_task = asyncio.create_task(_tick_clock())
+    yield
+    clock_task.cancel()
+    try:
+        await clock_task
+    except asyncio.CancelledError:
+        pass
+    await ANTHROPIC_CLIENT.aclose()
+    global_config.close_debug_log_file()
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib json module."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Get API keys from environment
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
@@ -82,6 +128,12 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 # Get OpenAI base URL from environment (if set)
 OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
 
+# Shared client for transparent forwarding, so connections to api.anthropic.com are reused
+ANTHROPIC_CLIENT = httpx.AsyncClient(
+    timeout=300.0,
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=256)
+)
+
 # Dynamic Configuration Manager
 class DynamicConfig:
     """动态配置管理类，用于在运行时存储和更新模型配置"""
@@ -323,9 +375,20 @@ ANTHROPIC_MODELS = [
     "claude-instant-1.2"
 ]
 
+# All known model names, for O(1) membership checks
+_ALL_MODELS = frozenset(OPENAI_MODELS) | frozenset(GEMINI_MODELS) | frozenset(ANTHROPIC_MODELS)
+_PROVIDER_PREFIXES = ("anthropic/", "openai/", "gemini/")
+
+def _strip_provider_prefix(model_name: str) -> str:
+    """Remove a leading provider prefix (anthropic/, openai/ or gemini/) from a model name."""
+    if model_name.startswith(_PROVIDER_PREFIXES):
+        return model_name.partition("/")[2]
+    return model_name
+
 # Helper function to determine model provider
+@lru_cache(maxsize=256)
 def get_model_provider(model_name: str) -> str:
-    """确定模型属于哪个提供商 - 使用动态配置"""
+    """确定模型属于哪个提供商 - 使用动态配置（提供商配置在进程生命周期内不变，结果可缓存）"""
     provider_name = global_config.find_model_provider(model_name)
     if provider_name:
         return provider_name
@@ -340,6 +403,10 @@ def get_model_provider(model_name: str) -> str:
     else:
         return "unknown"
 
+def display_model_name(model_name: str) -> str:
+    """Model name for console logs, without any provider prefix."""
+    return model_name.rpartition("/")[2]
+
 # Helper function to add correct provider prefix
 def add_model_prefix(model_name: str) -> str:
     """为模型添加正确的提供商前缀"""
@@ -479,13 +546,7 @@ class MessagesRequest(BaseModel):
         logger.debug(f"📋 MODEL VALIDATION: Original='{original_model}', SUPER='{super_model}', BIG='{big_model}', SMALL='{small_model}'")
 
         # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
+        clean_v = _strip_provider_prefix(v)
 
         # --- Enhanced Mapping Logic --- START ---
         mapped = False
@@ -560,13 +621,7 @@ class TokenCountRequest(BaseModel):
         logger.debug(f"📋 TOKEN COUNT VALIDATION: Original='{original_model}', SUPER='{super_model}', BIG='{big_model}', SMALL='{small_model}'")
 
         # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
+        clean_v = _strip_provider_prefix(v)
 
         # --- Mapping Logic --- START ---
         mapped = False
@@ -615,6 +670,12 @@ class TokenCountRequest(BaseModel):
 class TokenCountResponse(BaseModel):
     input_tokens: int
 
+class BatchTokenCountRequest(BaseModel):
+    items: List[TokenCountRequest]
+
+class BatchTokenCountResponse(BaseModel):
+    results: List[TokenCountResponse]
+
 # 动态配置相关的数据模型
 class ConfigUpdateRequest(BaseModel):
     preferred_provider: Optional[str] = None
@@ -690,56 +751,19 @@ async def log_requests(request: Request, call_next):
     method = request.method
     path = request.url.path
     
-    # 截取请求数据
-    request_data = {
-        "timestamp": datetime.now().isoformat(),
-        "method": method,
-        "path": path,
-        "headers": dict(request.headers),
-        "body": None,
-        "model": None,
-        "original_model": None
-    }
-    
-    # 如果是POST请求，尝试读取请求体
-    if method == "POST" and path in ["/v1/messages", "/v1/messages/count_tokens"]:
-        try:
-            # 读取请求体
-            body = await request.body()
-            if body:
-                body_str = body.decode('utf-8')
-                body_json = json.loads(body_str)
-                request_data["body"] = body_json
-                
-                # 提取模型信息
-                if "model" in body_json:
-                    request_data["model"] = body_json["model"]
-                if "original_model" in body_json:
-                    request_data["original_model"] = body_json["original_model"]
-                
-                # 重新创建请求对象，因为body已经被读取
-                from fastapi import Request as FastAPIRequest
-                from starlette.requests import Request as StarletteRequest
-                
-                # 创建新的请求对象
-                scope = request.scope.copy()
-                receive = lambda: {"type": "http.request", "body": body}
-                request = StarletteRequest(scope, receive)
-        except Exception as e:
-            logger.debug(f"Error reading request body: {e}")
-    
     # Log only basic request details at debug level
-    logger.debug(f"Request: {method} {path}")
+    logger.debug("Request: %s %s", method, path)
     
     # Process the request and get the response
     response = await call_next(request)
     
     # 添加到新配置系统的日志中
-    global_config.add_debug_log(
-        "request",
-        f"{method} {path}",
-        {"method": method, "path": path, "status_code": response.status_code}
-    )
+    if global_config.debug_log_enabled:
+        global_config.add_debug_log(
+            "request",
+            f"{method} {path}",
+            {"method": method, "path": path, "status_code": response.status_code}
+        )
     
     return response
 
@@ -754,26 +778,30 @@ def parse_tool_result_content(content):
         return content
         
     if isinstance(content, list):
-        result = ""
+        result_parts = []
         for item in content:
             if isinstance(item, dict) and item.get("type") == "text":
-                result += item.get("text", "") + "\n"
+                text = item.get("text", "")
+                if text:
+                    result_parts.append(text)
             elif isinstance(item, str):
-                result += item + "\n"
+                result_parts.append(item)
             elif isinstance(item, dict):
                 if "text" in item:
-                    result += item.get("text", "") + "\n"
+                    result_parts.append(item.get("text", ""))
                 else:
                     try:
-                        result += json.dumps(item) + "\n"
+                        result_parts.append(json.dumps(item))
                     except:
-                        result += str(item) + "\n"
+                        result_parts.append(str(item))
             else:
                 try:
-                    result += str(item) + "\n"
+                    result_parts.append(str(item))
                 except:
-                    result += "Unparseable content\n"
-        return result.strip()
+                    result_parts.append("Unparseable content")
+        result_text = "\n".join(result_parts)
+        # Whitespace-only results count as empty, so callers still substitute a placeholder
+        return result_text if result_text.strip() else ""
         
     if isinstance(content, dict):
         if content.get("type") == "text":
@@ -789,6 +817,171 @@ def parse_tool_result_content(content):
     except:
         return "Unparseable content"
 
+# Helper function to safely serialize objects for JSON (used when logging error details)
+_JSON_PRIMITIVES = (str, int, float, bool, type(None))
+
+def sanitize_for_json(obj, max_depth: int = 32):
+    """用显式栈迭代地清理对象使其可以JSON序列化（超过 max_depth 的层级转为字符串，避免循环引用）"""
+    root = [None]
+    stack = [(root, 0, obj, 0)]
+    while stack:
+        container, key, value, depth = stack.pop()
+        # 常见的基本类型直接保留
+        if isinstance(value, _JSON_PRIMITIVES):
+            container[key] = value
+            continue
+        if depth >= max_depth:
+            container[key] = str(value)
+            continue
+        
+        if not isinstance(value, (dict, list)):
+            if hasattr(value, '__dict__'):
+                value = value.__dict__
+                if not isinstance(value, dict):
+                    container[key] = str(value)
+                    continue
+            elif hasattr(value, 'text'):
+                container[key] = str(value.text)
+                continue
+            else:
+                try:
+                    orjson.dumps(value)
+                    container[key] = value
+                except TypeError:
+                    container[key] = str(value)
+                continue
+        
+        if isinstance(value, dict):
+            cleaned = {}
+            for k, v in value.items():
+                cleaned[k] = None  # 先占位，保持键的顺序
+                stack.append((cleaned, k, v, depth + 1))
+        else:
+            cleaned = [None] * len(value)
+            for i, item in enumerate(value):
+                stack.append((cleaned, i, item, depth + 1))
+        container[key] = cleaned
+    return root[0]
+
+def _block_type(block) -> Optional[str]:
+    """Return the type of a content block, whether it is a Pydantic model or a plain dict."""
+    if isinstance(block, dict):
+        return block.get("type")
+    return getattr(block, "type", None)
+
+def _block_text(block) -> str:
+    """Return the text of a text content block, whether it is a Pydantic model or a plain dict."""
+    if isinstance(block, dict):
+        return block.get("text", "")
+    return block.text
+
+def _extract_text(content) -> str:
+    """Extract the plain text of a message's content (a string or a list of content blocks)."""
+    if isinstance(content, str):
+        return content
+    parts = []
+    if isinstance(content, list):
+        for block in content:
+            if _block_type(block) == "text":
+                parts.append(_block_text(block))
+    text = "\n".join(parts)
+    return text if text.strip() else ""
+
+def _extract_conversation_messages(messages) -> List[tuple]:
+    """Extract (role, text) once per request for the conversation-history recorders."""
+    return [(msg.role, _extract_text(msg.content)) for msg in messages if msg.role in ('user', 'assistant')]
+
+def _append_tool_result_text(result_content, parts: List[str]) -> None:
+    """Append the text of a tool_result block's content to parts, one part per item."""
+    if isinstance(result_content, list):
+        for item in result_content:
+            if isinstance(item, dict) and item.get("type") == "text":
+                text = item.get("text", "")
+                if text:
+                    parts.append(text)
+            elif isinstance(item, dict):
+                # Handle any dict by trying to extract text or convert to JSON
+                if "text" in item:
+                    parts.append(item.get("text", ""))
+                else:
+                    try:
+                        parts.append(json.dumps(item))
+                    except:
+                        parts.append(str(item))
+    elif isinstance(result_content, dict):
+        if result_content.get("type") == "text":
+            parts.append(result_content.get("text", ""))
+        else:
+            try:
+                parts.append(json.dumps(result_content))
+            except:
+                parts.append(str(result_content))
+    elif isinstance(result_content, str):
+        parts.append(result_content)
+    else:
+        try:
+            parts.append(json.dumps(result_content))
+        except:
+            parts.append(str(result_content))
+
+# Gemini tool sets keyed by the sorted JSON dump of the Anthropic tools. The lock is needed
+# because token counting converts tools on a worker thread while the event loop does too
+_GEMINI_TOOLS_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_GEMINI_TOOLS_CACHE_SIZE = 64
+_GEMINI_TOOLS_CACHE_LOCK = threading.Lock()
+
+def _build_openai_tools(tool_dicts: List[Dict[str, Any]], is_gemini_model: bool) -> List[Dict[str, Any]]:
+    """Convert Anthropic tool dicts to OpenAI function tools, preserving the client's key order."""
+    openai_tools = []
+    for tool_dict in tool_dicts:
+        input_schema = tool_dict.get("input_schema", {})
+
+        # --- FIX: Validate and normalize the input schema ---
+        # Some backends hang on invalid or empty schemas (e.g., {}).
+        # A valid JSON Schema for function parameters must be an object.
+        if not isinstance(input_schema, dict) or "type" not in input_schema or "properties" not in input_schema:
+            logger.warning(f"Tool '{tool_dict['name']}' has an invalid or empty input_schema. Normalizing to a valid empty schema. Original: {input_schema}")
+            input_schema = {"type": "object", "properties": {}}
+
+        # Clean the schema if targeting a Gemini model
+        if is_gemini_model:
+            logger.debug(f"Cleaning schema for Gemini tool: {tool_dict.get('name')}")
+            input_schema = clean_gemini_schema(input_schema)
+
+        # Create OpenAI-compatible function tool
+        openai_tools.append({
+            "type": "function",
+            "function": {
+                "name": tool_dict["name"],
+                "description": tool_dict.get("description", ""),
+                "parameters": input_schema # Use potentially cleaned schema
+            }
+        })
+    return openai_tools
+
+def _get_openai_tools(tool_dicts: List[Dict[str, Any]], is_gemini_model: bool) -> List[Dict[str, Any]]:
+    """Return converted tools, reusing the Gemini conversion when the same tool set is sent again.
+
+    Only Gemini schema cleaning costs more than the cache lookup itself, so other models are
+    converted directly. The sorted dump is only the cache key; each call gets a fresh copy.
+    """
+    if not is_gemini_model:
+        return _build_openai_tools(tool_dicts, is_gemini_model)
+    
+    # The key is taken before conversion, since Gemini cleaning edits the schemas in place
+    cache_key = orjson.dumps(tool_dicts, option=orjson.OPT_SORT_KEYS)
+    with _GEMINI_TOOLS_CACHE_LOCK:
+        cached = _GEMINI_TOOLS_CACHE.get(cache_key)
+        if cached is not None:
+            _GEMINI_TOOLS_CACHE.move_to_end(cache_key)
+    if cached is None:
+        cached = orjson.dumps(_build_openai_tools(tool_dicts, is_gemini_model))
+        with _GEMINI_TOOLS_CACHE_LOCK:
+            _GEMINI_TOOLS_CACHE[cache_key] = cached
+            if len(_GEMINI_TOOLS_CACHE) > _GEMINI_TOOLS_CACHE_SIZE:
+                _GEMINI_TOOLS_CACHE.popitem(last=False)
+    return orjson.loads(cached)
+
 def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
     """Convert Anthropic API request format to LiteLLM format (which follows OpenAI)."""
     # LiteLLM already handles Anthropic models when using the format model="anthropic/claude-3-opus-20240229"
@@ -804,15 +997,16 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
             messages.append({"role": "system", "content": anthropic_request.system})
         elif isinstance(anthropic_request.system, list):
             # List of content blocks
-            system_text = ""
+            system_parts = []
             for block in anthropic_request.system:
-                if hasattr(block, 'type') and block.type == "text":
-                    system_text += block.text + "\n\n"
-                elif isinstance(block, dict) and block.get("type") == "text":
-                    system_text += block.get("text", "") + "\n\n"
+                if _block_type(block) == "text":
+                    text = _block_text(block)
+                    if text:
+                        system_parts.append(text)
             
-            if system_text:
-                messages.append({"role": "system", "content": system_text.strip()})
+            system_text = "\n\n".join(system_parts)
+            if system_text.strip():
+                messages.append({"role": "system", "content": system_text})
     
     # Add conversation messages
     for msg in anthropic_request.messages:
@@ -821,23 +1015,24 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
         
         # Check if content is a list of blocks
         if isinstance(content, list):
-            is_tool_result_message = any(getattr(block, 'type', None) == 'tool_result' for block in content)
-            is_tool_use_message = any(getattr(block, 'type', None) == 'tool_use' for block in content)
+            block_types = [getattr(block, 'type', None) for block in content]
+            is_tool_result_message = 'tool_result' in block_types
+            is_tool_use_message = 'tool_use' in block_types
 
             # --- BUG FIX: Correctly handle tool_result from user ---
             if role == "user" and is_tool_result_message:
-                for block in content:
-                    if getattr(block, 'type', None) == 'tool_result':
+                for block, block_type in zip(content, block_types):
+                    if block_type == 'tool_result':
                         # Convert to OpenAI's 'tool' role message
                         messages.append({
                             "role": "tool",
                             "tool_call_id": block.tool_use_id,
                             "content": parse_tool_result_content(block.content)
                         })
-                    elif getattr(block, 'type', None) == 'text' and block.text.strip():
+                    elif block_type == 'text' and block.text.strip():
                         # If there's other text, add it as a separate user message
                         messages.append({"role": "user", "content": block.text})
-                    elif getattr(block, 'type', None) == 'thinking':
+                    elif block_type == 'thinking':
                         # Filter out thinking blocks in user tool_result messages
                         continue
             
@@ -845,8 +1040,8 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
             elif role == "assistant" and is_tool_use_message:
                 tool_calls = []
                 text_parts = []
-                for block in content:
-                    if getattr(block, 'type', None) == 'tool_use':
+                for block, block_type in zip(content, block_types):
+                    if block_type == 'tool_use':
                         # Arguments must be a JSON string for OpenAI format
                         arguments_str = json.dumps(block.input)
                         tool_calls.append({
@@ -857,21 +1052,18 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
                                 "arguments": arguments_str
                             }
                         })
-                    elif getattr(block, 'type', None) == 'text':
+                    elif block_type == 'text':
                         text_parts.append(block.text)
-                    elif getattr(block, 'type', None) == 'thinking':
+                    elif block_type == 'thinking':
                         # Filter out thinking blocks in assistant tool_use messages
                         continue
                 
                 # Create an assistant message with tool_calls
-                assistant_message = {
-                    "role": "assistant",
-                    "content": " ".join(text_parts).strip() or None,
-                    "tool_calls": tool_calls
-                }
-                # content can be None if there are only tool_calls, which is valid
-                if assistant_message["content"] is None:
-                    del assistant_message["content"]
+                assistant_message = {"role": "assistant", "tool_calls": tool_calls}
+                # content is omitted if there are only tool_calls, which is valid
+                joined_text = " ".join(text_parts).strip()
+                if joined_text:
+                    assistant_message["content"] = joined_text
                     
                 messages.append(assistant_message)
 
@@ -880,16 +1072,15 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
                 # Fallback for messages with other kinds of blocks (like images)
                 # This part might need refinement if you use other block types
                 processed_content = []
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            processed_content.append({"type": "text", "text": block.text})
-                        elif block.type == "image":
-                            processed_content.append({"type": "image", "source": block.source})
-                        elif block.type == "thinking":
-                            # Filter out thinking blocks - they are Claude's internal reasoning
-                            # and not compatible with other API providers
-                            continue
+                for block, block_type in zip(content, block_types):
+                    if block_type == "text":
+                        processed_content.append({"type": "text", "text": block.text})
+                    elif block_type == "image":
+                        processed_content.append({"type": "image", "source": block.source})
+                    elif block_type == "thinking":
+                        # Filter out thinking blocks - they are Claude's internal reasoning
+                        # and not compatible with other API providers
+                        continue
                 messages.append({"role": role, "content": processed_content})
         
         # Handle simple string content
@@ -927,47 +1118,22 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     # Convert tools to OpenAI format
     if anthropic_request.tools:
-        openai_tools = []
-        is_gemini_model = anthropic_request.model.startswith("gemini/")
-
+        tool_dicts = []
         for tool in anthropic_request.tools:
             # Convert to dict if it's a pydantic model
             if hasattr(tool, 'dict'):
-                tool_dict = tool.dict()
+                tool_dicts.append(tool.dict())
             else:
                 # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
                 try:
-                    tool_dict = dict(tool) if not isinstance(tool, dict) else tool
+                    tool_dicts.append(dict(tool) if not isinstance(tool, dict) else tool)
                 except (TypeError, ValueError):
                      logger.error(f"Could not convert tool to dict: {tool}")
                      continue # Skip this tool if conversion fails
 
-            # Clean the schema if targeting a Gemini model
-            input_schema = tool_dict.get("input_schema", {})
-
-            # --- FIX: Validate and normalize the input schema ---
-            # Some backends hang on invalid or empty schemas (e.g., {}).
-            # A valid JSON Schema for function parameters must be an object.
-            if not isinstance(input_schema, dict) or "type" not in input_schema or "properties" not in input_schema:
-                logger.warning(f"Tool '{tool_dict['name']}' has an invalid or empty input_schema. Normalizing to a valid empty schema. Original: {input_schema}")
-                input_schema = {"type": "object", "properties": {}}
-            
-            if is_gemini_model:
-                 logger.debug(f"Cleaning schema for Gemini tool: {tool_dict.get('name')}")
-                 input_schema = clean_gemini_schema(input_schema)
-
-            # Create OpenAI-compatible function tool
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool_dict["name"],
-                    "description": tool_dict.get("description", ""),
-                    "parameters": input_schema # Use potentially cleaned schema
-                }
-            }
-            openai_tools.append(openai_tool)
-
-        litellm_request["tools"] = openai_tools
+        # Claude Code resends the same tool set on every turn, so the converted list is cached
+        is_gemini_model = anthropic_request.model.startswith("gemini/")
+        litellm_request["tools"] = _get_openai_tools(tool_dicts, is_gemini_model)
     
     # Convert tool_choice to OpenAI format if present
     if anthropic_request.tool_choice:
@@ -993,21 +1159,21 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     return litellm_request
 
+# Map OpenAI finish_reason to Anthropic stop_reason (anything else -> "end_turn")
+_STOP_REASON_MAP = {
+    "stop": "end_turn",
+    "length": "max_tokens",
+    "tool_calls": "tool_use",
+}
+
 def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any], 
                                  original_request: MessagesRequest) -> MessagesResponse:
     """Convert LiteLLM (OpenAI format) response to Anthropic API response format."""
     
     # Enhanced response extraction with better error handling
     try:
-        # Get the clean model name to check capabilities
-        clean_model = original_request.model
-        if clean_model.startswith("anthropic/"):
-            clean_model = clean_model[len("anthropic/"):]
-        elif clean_model.startswith("openai/"):
-            clean_model = clean_model[len("openai/"):]
-        
-        # Check if this is a Claude model (which supports content blocks)
-        is_claude_model = clean_model.startswith("claude-")
+        # Generate a single random id per response; fallback ids are derived from it
+        response_uid = uuid.uuid4().hex[:24]
         
         # Handle ModelResponse object from LiteLLM
         if hasattr(litellm_response, 'choices') and hasattr(litellm_response, 'usage'):
@@ -1018,7 +1184,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             tool_calls = message.tool_calls if message and hasattr(message, 'tool_calls') else None
             finish_reason = choices[0].finish_reason if choices and len(choices) > 0 else "stop"
             usage_info = litellm_response.usage
-            response_id = getattr(litellm_response, 'id', f"msg_{uuid.uuid4()}")
+            response_id = getattr(litellm_response, 'id', None) or f"msg_{response_uid}"
         else:
             # For backward compatibility - handle dict responses
             # If response is a dict, use it, otherwise try to convert to dict
@@ -1031,7 +1197,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                 except AttributeError:
                     # Fallback - manually extract attributes
                     response_dict = {
-                        "id": getattr(litellm_response, 'id', f"msg_{uuid.uuid4()}"),
+                        "id": getattr(litellm_response, 'id', None) or f"msg_{response_uid}",
                         "choices": getattr(litellm_response, 'choices', [{}]),
                         "usage": getattr(litellm_response, 'usage', {})
                     }
@@ -1043,14 +1209,14 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             tool_calls = message.get("tool_calls", None)
             finish_reason = choices[0].get("finish_reason", "stop") if choices and len(choices) > 0 else "stop"
             usage_info = response_dict.get("usage", {})
-            response_id = response_dict.get("id", f"msg_{uuid.uuid4()}")
+            response_id = response_dict.get("id") or f"msg_{response_uid}"
         
         # Create content list for Anthropic format
         content = []
         
         # Add text content block if present (text might be None or empty for pure tool call responses)
         if content_text is not None and content_text != "":
-            content.append({"type": "text", "text": content_text})
+            content.append(ContentBlockText.model_construct(type="text", text=content_text))
         
         # Add tool calls if present (tool_use in Anthropic format)
         if tool_calls:
@@ -1066,12 +1232,12 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                 # Extract function data based on whether it's a dict or object
                 if isinstance(tool_call, dict):
                     function = tool_call.get("function", {})
-                    tool_id = tool_call.get("id", f"tool_{uuid.uuid4()}")
+                    tool_id = tool_call.get("id") or f"toolu_{response_uid}_{idx}"
                     name = function.get("name", "")
                     arguments = function.get("arguments", "{}")
                 else:
                     function = getattr(tool_call, "function", None)
-                    tool_id = getattr(tool_call, "id", f"tool_{uuid.uuid4()}")
+                    tool_id = getattr(tool_call, "id", None) or f"toolu_{response_uid}_{idx}"
                     name = getattr(function, "name", "") if function else ""
                     arguments = getattr(function, "arguments", "{}") if function else "{}"
                 
@@ -1085,12 +1251,12 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                 
                 logger.debug(f"Adding tool_use block: id={tool_id}, name={name}, input={arguments}")
                 
-                content.append({
-                    "type": "tool_use",
-                    "id": tool_id,
-                    "name": name,
-                    "input": arguments
-                })
+                content.append(ContentBlockToolUse.model_construct(
+                    type="tool_use",
+                    id=tool_id,
+                    name=name,
+                    input=arguments
+                ))
         
         # Get usage information - extract values safely from object or dict
         if isinstance(usage_info, dict):
@@ -1101,31 +1267,27 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             completion_tokens = getattr(usage_info, "completion_tokens", 0)
         
         # Map OpenAI finish_reason to Anthropic stop_reason
-        stop_reason = None
-        if finish_reason == "stop":
-            stop_reason = "end_turn"
-        elif finish_reason == "length":
-            stop_reason = "max_tokens"
-        elif finish_reason == "tool_calls":
-            stop_reason = "tool_use"
-        else:
-            stop_reason = "end_turn"  # Default
+        stop_reason = _STOP_REASON_MAP.get(finish_reason, "end_turn")
         
         # Make sure content is never empty
         if not content:
-            content.append({"type": "text", "text": ""})
+            content.append(ContentBlockText.model_construct(type="text", text=""))
         
         # Create Anthropic-style response
-        anthropic_response = MessagesResponse(
+        # All fields were built above from trusted data, so skip Pydantic validation
+        anthropic_response = MessagesResponse.model_construct(
             id=response_id,
             model=original_request.model,
             role="assistant",
             content=content,
+            type="message",
             stop_reason=stop_reason,
             stop_sequence=None,
-            usage=Usage(
-                input_tokens=prompt_tokens,
-                output_tokens=completion_tokens
+            usage=Usage.model_construct(
+                input_tokens=prompt_tokens or 0,
+                output_tokens=completion_tokens or 0,
+                cache_creation_input_tokens=0,
+                cache_read_input_tokens=0
             )
         )
         
@@ -1147,11 +1309,19 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             usage=Usage(input_tokens=0, output_tokens=0)
         )
 
-async def handle_streaming(response_generator, original_request: MessagesRequest):
+_SSE_DONE = b"data: [DONE]\n\n"
+
+def _sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    """Encode one server-sent event as UTF-8 bytes so Starlette can pass it through as-is."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+async def handle_streaming(response_generator, original_request: MessagesRequest,
+                           conversation_messages: Optional[List[tuple]] = None):
     """Handle streaming responses from LiteLLM and convert to Anthropic format."""
     try:
         # Send message_start event
-        message_id = f"msg_{uuid.uuid4().hex[:24]}"  # Format similar to Anthropic's IDs
+        message_uid = uuid.uuid4().hex[:24]
+        message_id = f"msg_{message_uid}"  # Format similar to Anthropic's IDs
         
         message_data = {
             'type': 'message_start',
@@ -1171,13 +1341,13 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                 }
             }
         }
-        yield f"event: message_start\ndata: {json.dumps(message_data)}\n\n"
+        yield _sse_event("message_start", message_data)
         
         # Content block index for the first text block
-        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
+        yield _sse_event("content_block_start", {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
         
         # Send a ping to keep the connection alive (Anthropic does this)
-        yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
+        yield _sse_event("ping", {'type': 'ping'})
         
         tool_index = None
         current_tool_call = None
@@ -1191,7 +1361,7 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
         last_tool_index = 0
         
         # 用于记录对话历史
-        full_response_text = ""
+        full_response_parts = []
         
         # Process each chunk
         async for chunk in response_generator:
@@ -1231,12 +1401,12 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                     # Accumulate text content
                     if delta_content is not None and delta_content != "":
                         accumulated_text += delta_content
-                        full_response_text += delta_content  # 记录完整响应文本
+                        full_response_parts.append(delta_content)  # 记录完整响应文本
                         
                         # Always emit text deltas if no tool calls started
                         if tool_index is None and not text_block_closed:
                             text_sent = True
-                            yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})}\n\n"
+                            yield _sse_event("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})
                     
                     # Process tool calls
                     delta_tool_calls = None
@@ -1254,20 +1424,20 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             # If we've been streaming text, close that text block
                             if text_sent and not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                             # If we've accumulated text but not sent it, we need to emit it now
                             # This handles the case where the first delta has both text and a tool call
                             elif accumulated_text and not text_sent and not text_block_closed:
                                 # Send the accumulated text
                                 text_sent = True
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield _sse_event("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})
                                 # Close the text block
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                             # Close text block even if we haven't sent anything - models sometimes emit empty text blocks
                             elif not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                                 
                         # Convert to list if it's not already
                         if not isinstance(delta_tool_calls, list):
@@ -1294,14 +1464,14 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                                 if isinstance(tool_call, dict):
                                     function = tool_call.get('function', {})
                                     name = function.get('name', '') if isinstance(function, dict) else ""
-                                    tool_id = tool_call.get('id', f"toolu_{uuid.uuid4().hex[:24]}")
+                                    tool_id = tool_call.get('id') or f"toolu_{message_uid}_{anthropic_tool_index}"
                                 else:
                                     function = getattr(tool_call, 'function', None)
                                     name = getattr(function, 'name', '') if function else ''
-                                    tool_id = getattr(tool_call, 'id', f"toolu_{uuid.uuid4().hex[:24]}")
+                                    tool_id = getattr(tool_call, 'id', None) or f"toolu_{message_uid}_{anthropic_tool_index}"
                                 
                                 # Start a new tool_use block
-                                yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
+                                yield _sse_event("content_block_start", {'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})
                                 current_tool_call = tool_call
                                 tool_content = ""
                             
@@ -1316,24 +1486,18 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             
                             # If we have arguments, send them as a delta
                             if arguments:
-                                # Try to detect if arguments are valid JSON or just a fragment
-                                try:
-                                    # If it's already a dict, use it
-                                    if isinstance(arguments, dict):
-                                        args_json = json.dumps(arguments)
-                                    else:
-                                        # Otherwise, try to parse it
-                                        json.loads(arguments)
-                                        args_json = arguments
-                                except (json.JSONDecodeError, TypeError):
-                                    # If it's a fragment, treat it as a string
+                                # Arguments usually arrive as partial JSON fragments; pass strings through
+                                # untouched (clients reassemble input_json_delta) and only serialize dicts
+                                if isinstance(arguments, dict):
+                                    args_json = orjson.dumps(arguments).decode()
+                                else:
                                     args_json = arguments
                                 
                                 # Add to accumulated tool content
                                 tool_content += args_json if isinstance(args_json, str) else ""
                                 
                                 # Send the update
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
+                                yield _sse_event("content_block_delta", {'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})
                     
                     # Process finish_reason - end the streaming response
                     if finish_reason and not has_sent_stop_reason:
@@ -1342,67 +1506,29 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                         # Close any open tool call blocks
                         if tool_index is not None:
                             for i in range(1, last_tool_index + 1):
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                                yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': i})
                         
                         # If we accumulated text but never sent or closed text block, do it now
                         if not text_block_closed:
                             if accumulated_text and not text_sent:
                                 # Send the accumulated text
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield _sse_event("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})
                             # Close the text block
-                            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                            yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                         
                         # Map OpenAI finish_reason to Anthropic stop_reason
-                        stop_reason = "end_turn"
-                        if finish_reason == "length":
-                            stop_reason = "max_tokens"
-                        elif finish_reason == "tool_calls":
-                            stop_reason = "tool_use"
-                        elif finish_reason == "stop":
-                            stop_reason = "end_turn"
+                        stop_reason = _STOP_REASON_MAP.get(finish_reason, "end_turn")
                         
                         # Send message_delta with stop reason and usage
                         usage = {"output_tokens": output_tokens}
                         
-                        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
+                        yield _sse_event("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})
                         
                         # Send message_stop event
-                        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+                        yield _sse_event("message_stop", {'type': 'message_stop'})
                         
                         # Send final [DONE] marker to match Anthropic's behavior
-                        yield "data: [DONE]\n\n"
-                        
-                        # 记录对话历史
-                        try:
-                            # 记录用户消息
-                            for msg in original_request.messages:
-                                if msg.role in ['user', 'assistant']:
-                                    content_text = ""
-                                    if isinstance(msg.content, str):
-                                        content_text = msg.content
-                                    elif isinstance(msg.content, list):
-                                        for block in msg.content:
-                                            if hasattr(block, "type") and block.type == "text":
-                                                content_text += block.text + "\n"
-                                            elif isinstance(block, dict) and block.get("type") == "text":
-                                                content_text += block.get("text", "") + "\n"
-                                    
-                                    if content_text.strip():
-                                        global_config.add_conversation_message(
-                                            role=msg.role,
-                                            content=content_text.strip(),
-                                            model_used=original_request.model
-                                        )
-                            
-                            # 记录助手回复
-                            if full_response_text.strip():
-                                global_config.add_conversation_message(
-                                    role="assistant",
-                                    content=full_response_text.strip(),
-                                    model_used=original_request.model
-                                )
-                        except Exception as conv_error:
-                            logger.error(f"Error recording streaming conversation history: {conv_error}")
+                        yield _SSE_DONE
                         
                         return
             except Exception as e:
@@ -1415,53 +1541,21 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
             # Close any open tool call blocks
             if tool_index is not None:
                 for i in range(1, last_tool_index + 1):
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                    yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': i})
             
             # Close the text content block
-            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+            yield _sse_event("content_block_stop", {'type': 'content_block_stop', 'index': 0})
             
             # Send final message_delta with usage
             usage = {"output_tokens": output_tokens}
             
-            yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})}\n\n"
+            yield _sse_event("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})
             
             # Send message_stop event
-            yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+            yield _sse_event("message_stop", {'type': 'message_stop'})
             
             # Send final [DONE] marker to match Anthropic's behavior
-            yield "data: [DONE]\n\n"
-            
-            # 记录对话历史
-            try:
-                # 记录用户消息
-                for msg in original_request.messages:
-                    if msg.role in ['user', 'assistant']:
-                        content_text = ""
-                        if isinstance(msg.content, str):
-                            content_text = msg.content
-                        elif isinstance(msg.content, list):
-                            for block in msg.content:
-                                if hasattr(block, "type") and block.type == "text":
-                                    content_text += block.text + "\n"
-                                elif isinstance(block, dict) and block.get("type") == "text":
-                                    content_text += block.get("text", "") + "\n"
-                        
-                        if content_text.strip():
-                            global_config.add_conversation_message(
-                                role=msg.role,
-                                content=content_text.strip(),
-                                model_used=original_request.model
-                            )
-                
-                # 记录助手回复
-                if full_response_text.strip():
-                    global_config.add_conversation_message(
-                        role="assistant",
-                        content=full_response_text.strip(),
-                        model_used=original_request.model
-                    )
-            except Exception as conv_error:
-                logger.error(f"Error recording streaming conversation history (fallback): {conv_error}")
+            yield _SSE_DONE
     
     except Exception as e:
         import traceback
@@ -1470,52 +1564,45 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
         logger.error(error_message)
         
         # 记录失败的响应日志
-        global_config.add_debug_log(
-            "response",
-            f"Streaming response error for: {original_request.model}",
-            {
-                "model": original_request.model,
-                "error": error_message,
-                "stop_reason": "error",
-                "usage": {"input_tokens": 0, "output_tokens": 0}
-            }
-        )
+        if global_config.debug_log_enabled:
+            global_config.add_debug_log(
+                "response",
+                f"Streaming response error for: {original_request.model}",
+                {
+                    "model": original_request.model,
+                    "error": error_message,
+                    "stop_reason": "error",
+                    "usage": {"input_tokens": 0, "output_tokens": 0}
+                }
+            )
         
         # Send error message_delta
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})}\n\n"
+        yield _sse_event("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})
         
         # Send message_stop event
-        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+        yield _sse_event("message_stop", {'type': 'message_stop'})
         
         # Send final [DONE] marker
-        yield "data: [DONE]\n\n"
+        yield _SSE_DONE
     finally:
         # --- 日志记录 ---
         # 在流式传输成功结束后，记录完整的响应日志
+        full_response_text = "".join(full_response_parts)
         if not has_sent_stop_reason: # Fallback for streams that end without a finish_reason
             stop_reason = "end_turn"
         
-        # 记录完整的对话历史
+        # 记录完整的对话历史（唯一记录点，正常结束、提前结束和异常都会经过这里）
         try:
             # 记录用户消息
-            for msg in original_request.messages:
-                if msg.role in ['user', 'assistant']:
-                    content_text = ""
-                    if isinstance(msg.content, str):
-                        content_text = msg.content
-                    elif isinstance(msg.content, list):
-                        for block in msg.content:
-                            if hasattr(block, "type") and block.type == "text":
-                                content_text += block.text + "\n"
-                            elif isinstance(block, dict) and block.get("type") == "text":
-                                content_text += block.get("text", "") + "\n"
-                    
-                    if content_text.strip():
-                        global_config.add_conversation_message(
-                            role=msg.role,
-                            content=content_text.strip(),
-                            model_used=original_request.model
-                        )
+            if conversation_messages is None:
+                conversation_messages = _extract_conversation_messages(original_request.messages)
+            for role, content_text in conversation_messages:
+                if content_text.strip():
+                    global_config.add_conversation_message(
+                        role=role,
+                        content=content_text.strip(),
+                        model_used=original_request.model
+                    )
             
             # 记录助手回复
             if full_response_text.strip():
@@ -1528,33 +1615,30 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
             logger.error(f"Error recording streaming conversation history (finally block): {conv_error}")
 
         # 记录完整的调试日志
-        global_config.add_debug_log(
-            "response",
-            f"Streaming response complete for: {original_request.model}",
-            {
-                "response_id": message_id,
-                "model": original_request.model,
-                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
-                "content": full_response_text,
-                "stop_reason": stop_reason,
-                "full_response": {
-                    "id": message_id,
-                    "type": "message",
-                    "role": "assistant",
-                    "content": [{"type": "text", "text": full_response_text}],
+        if global_config.debug_log_enabled:
+            global_config.add_debug_log(
+                "response",
+                f"Streaming response complete for: {original_request.model}",
+                {
+                    "response_id": message_id,
                     "model": original_request.model,
-                    "stop_reason": stop_reason,
-                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}
+                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+                    "content": full_response_text,
+                    "stop_reason": stop_reason
                 }
-            }
-        )
+            )
 
 
 async def forward_to_anthropic(request: Union[MessagesRequest, TokenCountRequest], raw_request: Request):
     """Forward requests directly to Anthropic API when proxy is disabled."""
     try:
+        # Copy the incoming headers once; the same dict is logged and then forwarded
+        headers = dict(raw_request.headers)
+        log_headers = logger.isEnabledFor(logging.INFO)
+        
         # Debug: Log all request headers to understand what Claude Code is sending
-        logger.info(f"🔍 透明代理调试 - 收到的请求头部: {dict(raw_request.headers)}")
+        if log_headers:
+            logger.info("🔍 透明代理调试 - 收到的请求头部: %s", headers)
         
         # For Claude Pro users, we should use the original authentication completely
         # Check if we have ANTHROPIC_API_KEY set (manual API key users)
@@ -1583,24 +1667,24 @@ async def forward_to_anthropic(request: Union[MessagesRequest, TokenCountRequest
         body = await raw_request.body()
         
         # --- Start: Consistent Logging ---
-        try:
-            body_json = json.loads(body.decode('utf-8'))
-            global_config.add_debug_log(
-                "request",
-                f"Transparent forward request: {body_json.get('model', 'unknown')}",
-                {
-                    "model": body_json.get('model', 'unknown'),
-                    "messages_count": len(body_json.get('messages', [])),
-                    "stream": body_json.get('stream', False),
-                    "full_request": body_json
-                }
-            )
-        except json.JSONDecodeError:
-            logger.warning("Could not parse request body for transparent forward logging.")
+        if global_config.debug_log_enabled:
+            try:
+                body_json = orjson.loads(body) if body else {}
+                global_config.add_debug_log(
+                    "request",
+                    f"Transparent forward request: {body_json.get('model', 'unknown')}",
+                    {
+                        "model": body_json.get('model', 'unknown'),
+                        "messages_count": len(body_json.get('messages', [])),
+                        "stream": body_json.get('stream', False),
+                        "full_request": body_json
+                    }
+                )
+            except json.JSONDecodeError:
+                logger.warning("Could not parse request body for transparent forward logging.")
         # --- End: Consistent Logging ---
         
         # Start with all original headers except host
-        headers = dict(raw_request.headers)
         headers.pop("host", None)
         
         # Handle authentication based on user type
@@ -1618,75 +1702,102 @@ async def forward_to_anthropic(request: Union[MessagesRequest, TokenCountRequest
         if "anthropic-version" not in headers:
             headers["anthropic-version"] = "2023-06-01"
             
-        logger.info(f"🔍 透明代理调试 - 发送到Anthropic的头部: {dict(headers)}")
-        
-        # Forward the request to Anthropic API
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(
-                anthropic_url,
-                headers=headers,
-                content=body
+        if log_headers:
+            logger.info("🔍 透明代理调试 - 发送到Anthropic的头部: %s", headers)
+        
+        # Forward the request to Anthropic API over the shared connection pool
+        is_stream = request.stream if hasattr(request, 'stream') else False
+        upstream_request = ANTHROPIC_CLIENT.build_request("POST", anthropic_url, headers=headers, content=body)
+        response = await ANTHROPIC_CLIENT.send(upstream_request, stream=is_stream)
+        
+        # Check if the request was successful
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            logger.error(f"Anthropic API error: {response.status_code} - {response.text}")
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Anthropic API error: {response.text}"
             )
-            
-            # Check if the request was successful
-            if response.status_code != 200:
-                logger.error(f"Anthropic API error: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Anthropic API error: {response.text}"
-                )
-            
-            # For streaming responses
-            if request.stream if hasattr(request, 'stream') else False:
-                async def stream_and_log_response():
-                    full_response_bytes = b""
+        
+        # For streaming responses
+        if is_stream:
+            async def stream_and_log_response():
+                # Parse SSE lines incrementally as chunks pass through; only the text deltas are kept
+                response_parts = []
+                stop_reason = "end_turn"
+                leftover = b""
+                
+                def collect_line(line: bytes):
+                    nonlocal stop_reason
+                    if not line.startswith(b"data:"):
+                        return
+                    data = line[5:].strip()
+                    if not data or data == b"[DONE]":
+                        return
+                    try:
+                        data_json = orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        return
+                    event_type = data_json.get('type')
+                    if event_type == 'content_block_delta':
+                        delta = data_json.get('delta', {})
+                        if delta.get('type') == 'text_delta':
+                            response_parts.append(delta.get('text', ''))
+                    elif event_type == 'message_delta':
+                        stop_reason = data_json.get('delta', {}).get('stop_reason') or stop_reason
+                
+                log_enabled = global_config.debug_log_enabled
+                try:
                     async for chunk in response.aiter_bytes():
-                        full_response_bytes += chunk
                         yield chunk
-                    
-                    try:
-                        full_response_text = full_response_bytes.decode('utf-8')
-                        response_content = ""
-                        for line in full_response_text.splitlines():
-                            if line.startswith('data:'):
-                                data_str = line[len('data:'):].strip()
-                                if data_str != '[DONE]':
-                                    try:
-                                        data_json = json.loads(data_str)
-                                        if data_json.get('type') == 'content_block_delta':
-                                            delta = data_json.get('delta', {})
-                                            if delta.get('type') == 'text_delta':
-                                                response_content += delta.get('text', '')
-                                    except json.JSONDecodeError:
-                                        pass
-                        
-                        global_config.add_debug_log(
-                            "response",
-                            f"Transparent streaming response complete for: {request.model}",
-                            {
-                                "model": request.model,
-                                "content": response_content,
-                                "stop_reason": "end_turn",
-                                "full_response": full_response_text
-                            }
-                        )
-                    except Exception as log_e:
-                        logger.error(f"Error logging transparent streaming response: {log_e}")
+                        if not log_enabled:
+                            continue
+                        try:
+                            lines = (leftover + chunk).split(b"\n")
+                            leftover = lines.pop()
+                            for line in lines:
+                                collect_line(line)
+                        except Exception as parse_e:
+                            logger.debug(f"Error parsing transparent streaming chunk: {parse_e}")
+                finally:
+                    await response.aclose()
+                
+                if not log_enabled:
+                    return
+                try:
+                    collect_line(leftover)
+                    global_config.add_debug_log(
+                        "response",
+                        f"Transparent streaming response complete for: {request.model}",
+                        {
+                            "model": request.model,
+                            "content": "".join(response_parts),
+                            "stop_reason": stop_reason
+                        }
+                    )
+                except Exception as log_e:
+                    logger.error(f"Error logging transparent streaming response: {log_e}")
 
-                return StreamingResponse(
-                    stream_and_log_response(),
-                    media_type="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
-                )
-            else:
-                # For non-streaming responses, return JSON
-                response_json = response.json()
+            # The generator's finally only runs if iteration starts; the background task also
+            # releases the pooled connection when the client goes away before that (aclose is idempotent)
+            return StreamingResponse(
+                stream_and_log_response(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
+                background=BackgroundTask(response.aclose)
+            )
+        else:
+            # For non-streaming responses, return JSON
+            if global_config.debug_log_enabled:
+                response_json = orjson.loads(response.content)
                 
-                response_content = ""
+                content_buffer = io.StringIO()
                 if 'content' in response_json and isinstance(response_json['content'], list):
                     for block in response_json['content']:
                         if block.get('type') == 'text':
-                            response_content += block.get('text', '')
+                            content_buffer.write(block.get('text', ''))
+                response_content = content_buffer.getvalue()
                 
                 global_config.add_debug_log(
                     "response",
@@ -1699,11 +1810,13 @@ async def forward_to_anthropic(request: Union[MessagesRequest, TokenCountRequest
                         "full_response": response_json
                     }
                 )
-                
-                return JSONResponse(
-                    content=response_json,
-                    status_code=response.status_code
-                )
+            
+            # Pass the upstream bytes through instead of re-serializing the parsed JSON
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type="application/json"
+            )
                 
     except HTTPException:
         raise
@@ -1714,6 +1827,211 @@ async def forward_to_anthropic(request: Union[MessagesRequest, TokenCountRequest
             detail=f"Error forwarding to Anthropic API: {str(e)}"
         )
 
+def _response_cache_key(request: MessagesRequest, upstream_requests: List[Dict[str, Any]]) -> str:
+    """Hash every request field that shapes the upstream response, for the exact-match response cache.
+    
+    The resolved model and base URL of each upstream request are part of the key, so switching
+    providers or the race model never replays an answer from the previous backend.
+    """
+    payload = request.model_dump(exclude={"stream", "metadata", "original_model"}, exclude_none=True)
+    payload["upstream"] = [(upstream.get("model"), upstream.get("api_base")) for upstream in upstream_requests]
+    return hashlib.sha256(orjson.dumps(payload, default=str, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def race_models(primary_coro, secondary_coro):
+    """Run two completions concurrently and return (winner_index, result) for the first success.
+    
+    winner_index is 0 for the primary and 1 for the secondary. The slower call is cancelled. If the first call to finish fails, the other one is awaited;
+    the first error is raised only when both fail.
+    """
+    tasks = [asyncio.create_task(primary_coro), asyncio.create_task(secondary_coro)]
+    pending = set(tasks)
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return tasks.index(task), task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _race_messages_request(request: MessagesRequest, race_model: str) -> Optional[MessagesRequest]:
+    """Copy of the original request aimed at race_model, or None if racing does not apply.
+    
+    It goes through _build_litellm_request like the primary, so it is shaped for the race model's own provider.
+    """
+    race_model = _strip_provider_prefix(race_model)
+    if race_model == _strip_provider_prefix(request.model):
+        return None
+    
+    provider_name = global_config.find_model_provider(race_model)
+    provider = global_config.providers.get(provider_name) if provider_name else None
+    if provider is None or not provider.is_available:
+        logger.warning(f"Race model '{race_model}' has no configured provider - racing skipped")
+        return None
+    
+    return request.model_copy(update={"model": race_model})
+
+# Message fields OpenAI accepts; anything else is dropped before the request is sent
+_OPENAI_MESSAGE_KEYS = ("role", "content", "name", "tool_call_id", "tool_calls")
+
+def _build_litellm_request(request: MessagesRequest) -> Dict[str, Any]:
+    """Convert a MessagesRequest into the LiteLLM request for its model's provider."""
+    # Split the provider prefix off once; model_prefix is "" for unprefixed model names
+    model_prefix, has_prefix, _ = request.model.partition("/")
+    if not has_prefix:
+        model_prefix = ""
+    
+    # Convert Anthropic request to LiteLLM format
+    litellm_request = convert_anthropic_to_litellm(request)
+    
+    # Determine which API key to use based on the model using new config system
+    provider_name = global_config.find_model_provider(request.model)
+    if provider_name and provider_name in global_config.providers:
+        provider = global_config.providers[provider_name]
+        litellm_request["api_key"] = provider.api_key
+        litellm_request["api_base"] = provider.base_url  # LiteLLM will append /chat/completions automatically
+        logger.debug(f"Using {provider.name} API key and base URL {litellm_request['api_base']} for model: {request.model}")
+        
+        # Add provider prefix to model name for LiteLLM
+        if provider.api_format == "openai":
+            # For OpenAI-compatible providers, use openai/ prefix with the actual model name
+            if model_prefix != "openai":
+                litellm_request["model"] = f"openai/{request.model}"
+        else:
+            # For other providers, add provider-specific prefix if needed
+            if model_prefix != provider_name:
+                litellm_request["model"] = f"{provider_name}/{request.model}"
+    else:
+        # Fallback to old logic for backward compatibility
+        if model_prefix == "openai":
+            litellm_request["api_key"] = OPENAI_API_KEY
+            if OPENAI_BASE_URL:
+                litellm_request["api_base"] = OPENAI_BASE_URL
+        elif model_prefix == "gemini":
+            litellm_request["api_key"] = GEMINI_API_KEY
+        else:
+            litellm_request["api_key"] = ANTHROPIC_API_KEY
+        logger.debug(f"Using fallback API key selection for model: {request.model}")
+    
+    # For OpenAI models - modify request format to work with limitations
+    if "openai" in litellm_request["model"] and "messages" in litellm_request:
+        logger.debug(f"Processing OpenAI model request: {litellm_request['model']}")
+        
+        # For OpenAI models, we need to convert content blocks to simple strings
+        # and handle other requirements
+        needs_revalidation = False  # set when a message is left without string content
+        for i, msg in enumerate(litellm_request["messages"]):
+            # 1. Handle content field - plain string content (the common case) only
+            # needs the empty check
+            content = msg.get("content")
+            if isinstance(content, str):
+                if not content:
+                    litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
+            
+            # Content blocks - a single pass records whether they are all tool_result
+            # blocks while extracting the text, and the output format is decided once
+            # the loop is done
+            elif isinstance(content, list):
+                text_parts = []
+                tool_result_headers = []  # positions of the tool_result header lines in text_parts
+                dict_text_results = []  # (position, content) of tool_result dict content of type "text"
+                is_only_tool_result = True
+                for block in content:
+                    if not isinstance(block, dict):
+                        is_only_tool_result = False
+                        continue
+                    
+                    block_type = block.get("type")
+                    if block_type != "tool_result":
+                        is_only_tool_result = False
+                    
+                    # Handle different content block types
+                    if block_type == "text":
+                        text = block.get("text", "")
+                        if text:
+                            text_parts.append(text)
+                    
+                    # Handle tool_result content blocks - extract nested text
+                    elif block_type == "tool_result":
+                        tool_id = block.get("tool_use_id", "unknown")
+                        tool_result_headers.append(len(text_parts))
+                        text_parts.append(f"[Tool Result ID: {tool_id}]")
+                        result_content = block.get("content", [])
+                        if isinstance(result_content, dict) and result_content.get("type") == "text":
+                            dict_text_results.append((len(text_parts), result_content))
+                        _append_tool_result_text(result_content, text_parts)
+                    
+                    # Handle tool_use content blocks
+                    elif block_type == "tool_use":
+                        tool_name = block.get("name", "unknown")
+                        tool_id = block.get("id", "unknown")
+                        tool_input = orjson.dumps(block.get("input") or {}).decode()
+                        text_parts.append(f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n")
+                    
+                    # Handle image content blocks
+                    elif block_type == "image":
+                        text_parts.append("[Image content - not displayed in text format]")
+                
+                # Special case - a message made only of tool_result blocks
+                if is_only_tool_result and tool_result_headers:
+                    logger.warning(f"Found message with only tool_result content - special handling required")
+                    for pos in tool_result_headers:
+                        text_parts[pos] = "Tool Result:"
+                    # This format has always dumped dict content as JSON rather than taking its text
+                    for pos, result_content in dict_text_results:
+                        try:
+                            text_parts[pos] = json.dumps(result_content)
+                        except:
+                            text_parts[pos] = str(result_content)
+                    all_text = "\n".join(text_parts)
+                    litellm_request["messages"][i]["content"] = all_text if all_text.strip() else "..."
+                    logger.warning(f"Converted tool_result to plain text: {all_text[:200]}...")
+                    continue  # Skip normal processing for this message
+                
+                # Make sure content is never empty for OpenAI models
+                text_content = "\n".join(text_parts)
+                litellm_request["messages"][i]["content"] = text_content if text_content.strip() else "..."
+            # Also check for None content
+            elif content is None and "content" in msg:
+                litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
+            # Missing content (e.g. tool_calls-only assistant messages) or an unexpected type
+            else:
+                needs_revalidation = True
+            
+            # 2. Remove any fields OpenAI doesn't support in messages
+            filtered_msg = {key: msg[key] for key in _OPENAI_MESSAGE_KEYS if key in msg}
+            if len(filtered_msg) != len(msg):
+                for key in msg.keys() - filtered_msg.keys():
+                    logger.warning(f"Removing unsupported field from message: {key}")
+                litellm_request["messages"][i] = filtered_msg
+        
+        # 3. Final validation - only needed when step 1 left some message without string content
+        if needs_revalidation:
+            for i, msg in enumerate(litellm_request["messages"]):
+                # Log the message format for debugging
+                logger.debug(f"Message {i} format check - role: {msg.get('role')}, content type: {type(msg.get('content'))}")
+            
+                # If content is still a list or None, replace with placeholder
+                if isinstance(msg.get("content"), list):
+                    logger.warning(f"CRITICAL: Message {i} still has list content after processing: {json.dumps(msg.get('content'))}")
+                    # Last resort - stringify the entire content as JSON
+                    litellm_request["messages"][i]["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
+                elif msg.get("content") is None:
+                    logger.warning(f"Message {i} has None content - replacing with placeholder")
+                    litellm_request["messages"][i]["content"] = "..." # Fallback placeholder
+    
+    # Only log basic info about the request, not the full details
+    logger.debug(f"Request for model: {litellm_request.get('model')}, stream: {litellm_request.get('stream', False)}")
+    
+    # Add a timeout to the request
+    litellm_request['timeout'] = 300  # 300 seconds timeout
+    
+    return litellm_request
+
 @app.post("/v1/messages")
 async def create_message(
     request: MessagesRequest,
@@ -1729,223 +2047,40 @@ async def create_message(
         # print the body here
         body = await raw_request.body()
     
-        # Parse the raw body as JSON since it's bytes
-        body_json = json.loads(body.decode('utf-8'))
+        # Parse the raw body as JSON (orjson accepts bytes directly)
+        body_json = orjson.loads(body) if body else {}
         original_model = body_json.get("model", "unknown")
         
         # Get the display name for logging, just the model name without provider prefix
-        display_model = original_model
-        if "/" in display_model:
-            display_model = display_model.split("/")[-1]
-        
-        # Clean model name for capability check
-        clean_model = request.model
-        if clean_model.startswith("anthropic/"):
-            clean_model = clean_model[len("anthropic/"):]
-        elif clean_model.startswith("openai/"):
-            clean_model = clean_model[len("openai/"):]
+        display_model = display_model_name(original_model)
         
         logger.debug(f"📊 PROCESSING REQUEST: Model={request.model}, Stream={request.stream}")
         
-        # 记录调试日志 - 包含完整Anthropic请求内容
-        global_config.add_debug_log(
-            "request",
-            f"Anthropic messages request: {request.model}",
-            {
-                "model": request.model,
-                "messages_count": len(request.messages),
-                "messages": [{"role": msg.role, "content": msg.content} for msg in request.messages],
-                "max_tokens": request.max_tokens,
-                "temperature": request.temperature,
-                "stream": request.stream,
-                "full_request": {
+        # 每条消息的文本只提取一次，供对话记录复用
+        conversation_messages = _extract_conversation_messages(request.messages)
+        
+        # 记录调试日志 - 包含完整Anthropic请求内容（顶层已有的字段不在 full_request 中重复）
+        if global_config.debug_log_enabled:
+            global_config.add_debug_log(
+                "request",
+                f"Anthropic messages request: {request.model}",
+                {
                     "model": request.model,
-                    "messages": [{"role": msg.role, "content": msg.content} for msg in request.messages],
+                    "messages_count": len(request.messages),
                     "max_tokens": request.max_tokens,
                     "temperature": request.temperature,
                     "stream": request.stream,
-                    "top_k": getattr(request, 'top_k', None),
-                    "top_p": getattr(request, 'top_p', None),
-                    "stop_sequences": getattr(request, 'stop_sequences', None)
+                    "full_request": {
+                        "messages": [{"role": msg.role, "content": msg.content} for msg in request.messages],
+                        "top_k": request.top_k,
+                        "top_p": request.top_p,
+                        "stop_sequences": request.stop_sequences
+                    }
                 }
-            }
-        )
-        
-        # Convert Anthropic request to LiteLLM format
-        litellm_request = convert_anthropic_to_litellm(request)
-        
-        # Determine which API key to use based on the model using new config system
-        provider_name = global_config.find_model_provider(request.model)
-        if provider_name and provider_name in global_config.providers:
-            provider = global_config.providers[provider_name]
-            litellm_request["api_key"] = provider.api_key
-            litellm_request["api_base"] = provider.base_url  # LiteLLM will append /chat/completions automatically
-            logger.debug(f"Using {provider.name} API key and base URL {litellm_request['api_base']} for model: {request.model}")
-            
-            # Add provider prefix to model name for LiteLLM
-            if provider.api_format == "openai":
-                # For OpenAI-compatible providers, use openai/ prefix with the actual model name
-                if not request.model.startswith("openai/"):
-                    litellm_request["model"] = f"openai/{request.model}"
-            else:
-                # For other providers, add provider-specific prefix if needed
-                if not request.model.startswith(f"{provider_name}/"):
-                    litellm_request["model"] = f"{provider_name}/{request.model}"
-        else:
-            # Fallback to old logic for backward compatibility
-            if request.model.startswith("openai/"):
-                litellm_request["api_key"] = OPENAI_API_KEY
-                if OPENAI_BASE_URL:
-                    litellm_request["api_base"] = OPENAI_BASE_URL
-            elif request.model.startswith("gemini/"):
-                litellm_request["api_key"] = GEMINI_API_KEY
-            else:
-                litellm_request["api_key"] = ANTHROPIC_API_KEY
-            logger.debug(f"Using fallback API key selection for model: {request.model}")
-        
-        # For OpenAI models - modify request format to work with limitations
-        if "openai" in litellm_request["model"] and "messages" in litellm_request:
-            logger.debug(f"Processing OpenAI model request: {litellm_request['model']}")
-            
-            # For OpenAI models, we need to convert content blocks to simple strings
-            # and handle other requirements
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Special case - handle message content directly when it's a list of tool_result
-                # This is a specific case we're seeing in the error
-                if "content" in msg and isinstance(msg["content"], list):
-                    is_only_tool_result = True
-                    for block in msg["content"]:
-                        if not isinstance(block, dict) or block.get("type") != "tool_result":
-                            is_only_tool_result = False
-                            break
-                    
-                    if is_only_tool_result and len(msg["content"]) > 0:
-                        logger.warning(f"Found message with only tool_result content - special handling required")
-                        # Extract the content from all tool_result blocks
-                        all_text = ""
-                        for block in msg["content"]:
-                            all_text += "Tool Result:\n"
-                            result_content = block.get("content", [])
-                            
-                            # Handle different formats of content
-                            if isinstance(result_content, list):
-                                for item in result_content:
-                                    if isinstance(item, dict) and item.get("type") == "text":
-                                        all_text += item.get("text", "") + "\n"
-                                    elif isinstance(item, dict):
-                                        # Fall back to string representation of any dict
-                                        try:
-                                            item_text = item.get("text", json.dumps(item))
-                                            all_text += item_text + "\n"
-                                        except:
-                                            all_text += str(item) + "\n"
-                            elif isinstance(result_content, str):
-                                all_text += result_content + "\n"
-                            else:
-                                try:
-                                    all_text += json.dumps(result_content) + "\n"
-                                except:
-                                    all_text += str(result_content) + "\n"
-                        
-                        # Replace the list with extracted text
-                        litellm_request["messages"][i]["content"] = all_text.strip() or "..."
-                        logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
-                        continue  # Skip normal processing for this message
-                
-                # 1. Handle content field - normal case
-                if "content" in msg:
-                    # Check if content is a list (content blocks)
-                    if isinstance(msg["content"], list):
-                        # Convert complex content blocks to simple string
-                        text_content = ""
-                        for block in msg["content"]:
-                            if isinstance(block, dict):
-                                # Handle different content block types
-                                if block.get("type") == "text":
-                                    text_content += block.get("text", "") + "\n"
-                                
-                                # Handle tool_result content blocks - extract nested text
-                                elif block.get("type") == "tool_result":
-                                    tool_id = block.get("tool_use_id", "unknown")
-                                    text_content += f"[Tool Result ID: {tool_id}]\n"
-                                    
-                                    # Extract text from the tool_result content
-                                    result_content = block.get("content", [])
-                                    if isinstance(result_content, list):
-                                        for item in result_content:
-                                            if isinstance(item, dict) and item.get("type") == "text":
-                                                text_content += item.get("text", "") + "\n"
-                                            elif isinstance(item, dict):
-                                                # Handle any dict by trying to extract text or convert to JSON
-                                                if "text" in item:
-                                                    text_content += item.get("text", "") + "\n"
-                                                else:
-                                                    try:
-                                                        text_content += json.dumps(item) + "\n"
-                                                    except:
-                                                        text_content += str(item) + "\n"
-                                    elif isinstance(result_content, dict):
-                                        # Handle dictionary content
-                                        if result_content.get("type") == "text":
-                                            text_content += result_content.get("text", "") + "\n"
-                                        else:
-                                            try:
-                                                text_content += json.dumps(result_content) + "\n"
-                                            except:
-                                                text_content += str(result_content) + "\n"
-                                    elif isinstance(result_content, str):
-                                        text_content += result_content + "\n"
-                                    else:
-                                        try:
-                                            text_content += json.dumps(result_content) + "\n"
-                                        except:
-                                            text_content += str(result_content) + "\n"
-                                
-                                # Handle tool_use content blocks
-                                elif block.get("type") == "tool_use":
-                                    tool_name = block.get("name", "unknown")
-                                    tool_id = block.get("id", "unknown")
-                                    tool_input = json.dumps(block.get("input", {}))
-                                    text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
-                                
-                                # Handle image content blocks
-                                elif block.get("type") == "image":
-                                    text_content += "[Image content - not displayed in text format]\n"
-                        
-                        # Make sure content is never empty for OpenAI models
-                        if not text_content.strip():
-                            text_content = "..."
-                        
-                        litellm_request["messages"][i]["content"] = text_content.strip()
-                    # Also check for None or empty string content
-                    elif msg["content"] is None:
-                        litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
-                
-                # 2. Remove any fields OpenAI doesn't support in messages
-                for key in list(msg.keys()):
-                    if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
-                        logger.warning(f"Removing unsupported field from message: {key}")
-                        del msg[key]
-            
-            # 3. Final validation - check for any remaining invalid values and dump full message details
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Log the message format for debugging
-                logger.debug(f"Message {i} format check - role: {msg.get('role')}, content type: {type(msg.get('content'))}")
-                
-                # If content is still a list or None, replace with placeholder
-                if isinstance(msg.get("content"), list):
-                    logger.warning(f"CRITICAL: Message {i} still has list content after processing: {json.dumps(msg.get('content'))}")
-                    # Last resort - stringify the entire content as JSON
-                    litellm_request["messages"][i]["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
-                elif msg.get("content") is None:
-                    logger.warning(f"Message {i} has None content - replacing with placeholder")
-                    litellm_request["messages"][i]["content"] = "..." # Fallback placeholder
-        
-        # Only log basic info about the request, not the full details
-        logger.debug(f"Request for model: {litellm_request.get('model')}, stream: {litellm_request.get('stream', False)}")
+            )
         
-        # Add a timeout to the request
-        litellm_request['timeout'] = 300  # 300 seconds timeout
+        # Convert Anthropic request to LiteLLM format for the mapped model's provider
+        litellm_request = _build_litellm_request(request)
 
         # Handle streaming mode
         if request.stream:
@@ -1965,7 +2100,7 @@ async def create_message(
             response_generator = await litellm.acompletion(**litellm_request)
             
             return StreamingResponse(
-                handle_streaming(response_generator, request),
+                handle_streaming(response_generator, request, conversation_messages),
                 media_type="text/event-stream"
             )
         else:
@@ -1981,84 +2116,99 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            start_time = time.time()
-            litellm_response = litellm.completion(**litellm_request)
-            logger.debug(f"✅ RESPONSE RECEIVED: Model={litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
+            # Optionally race a secondary model against the primary; the first success wins
+            race_model = global_config.current_config.get("race_model")
+            race_messages_request = _race_messages_request(request, race_model) if race_model else None
+            race_request = _build_litellm_request(race_messages_request) if race_messages_request is not None else None
+            
+            # Identical non-streaming requests can be answered from the response cache. Only
+            # temperature 0 requests are cached; a sampled request should get a fresh sample
+            cache_key = None
+            anthropic_response = None
+            if global_config.current_config.get("response_cache_enabled") and request.temperature == 0:
+                upstream_requests = [litellm_request] if race_request is None else [litellm_request, race_request]
+                cache_key = _response_cache_key(request, upstream_requests)
+                cached_response = global_config.get_cached_response(cache_key)
+                if cached_response is not None:
+                    logger.debug(f"Response cache hit for model: {request.model}")
+                    # Every caller gets its own copy with a fresh message id
+                    anthropic_response = cached_response.model_copy(update={"id": f"msg_{uuid.uuid4()}"}, deep=True)
             
-            # Convert LiteLLM response to Anthropic format
-            anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
+            # The request whose model actually answered (the race model's copy when it wins)
+            served_request = request
+            if anthropic_response is None:
+                start_time = time.time()
+                served_litellm_request = litellm_request
+                if race_request is not None:
+                    winner_index, litellm_response = await race_models(
+                        litellm.acompletion(**litellm_request),
+                        litellm.acompletion(**race_request)
+                    )
+                    if winner_index == 1:
+                        served_request = race_messages_request
+                        served_litellm_request = race_request
+                    logger.info(f"🏁 RACE WON: Model={served_litellm_request.get('model')}, Primary={litellm_request.get('model')}, Race={race_request.get('model')}")
+                else:
+                    litellm_response = await litellm.acompletion(**litellm_request)
+                logger.debug(f"✅ RESPONSE RECEIVED: Model={served_litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
+                
+                # Convert LiteLLM response to Anthropic format
+                anthropic_response = convert_litellm_to_anthropic(litellm_response, served_request)
+                
+                # Only cache real completions (the conversion fallback reports no output tokens)
+                if cache_key is not None and anthropic_response.usage.output_tokens:
+                    global_config.cache_response(cache_key, anthropic_response)
             
             # 记录对话历史
             try:
                 # 记录用户消息
-                for msg in request.messages:
-                    if msg.role in ['user', 'assistant']:
-                        content_text = ""
-                        if isinstance(msg.content, str):
-                            content_text = msg.content
-                        elif isinstance(msg.content, list):
-                            # 从复杂内容块中提取文本
-                            for block in msg.content:
-                                if hasattr(block, "type") and block.type == "text":
-                                    content_text += block.text + "\n"
-                                elif isinstance(block, dict) and block.get("type") == "text":
-                                    content_text += block.get("text", "") + "\n"
-                        
-                        if content_text.strip():
-                            global_config.add_conversation_message(
-                                role=msg.role,
-                                content=content_text.strip(),
-                                model_used=request.model
-                            )
+                for role, content_text in conversation_messages:
+                    if content_text.strip():
+                        global_config.add_conversation_message(
+                            role=role,
+                            content=content_text.strip(),
+                            model_used=served_request.model
+                        )
                 
                 # 记录助手回复
                 if anthropic_response.content:
-                    assistant_text = ""
+                    text_parts = []
                     for content_block in anthropic_response.content:
-                        # 处理 Pydantic 模型对象
-                        if hasattr(content_block, 'type') and content_block.type == "text":
-                            assistant_text += content_block.text + "\n"
-                        # 处理字典格式
-                        elif isinstance(content_block, dict) and content_block.get("type") == "text":
-                            assistant_text += content_block.get("text", "") + "\n"
+                        # 同时支持 Pydantic 模型对象和字典格式
+                        if _block_type(content_block) == "text":
+                            text = _block_text(content_block)
+                            if text.strip():
+                                text_parts.append(text)
                     
-                    if assistant_text.strip():
+                    if text_parts:
                         global_config.add_conversation_message(
                             role="assistant",
-                            content=assistant_text.strip(),
-                            model_used=request.model
+                            content="\n".join(text_parts),
+                            model_used=served_request.model
                         )
                         
             except Exception as conv_error:
                 logger.error(f"Error recording conversation history: {conv_error}")
             
             # 记录调试日志 - 包含完整响应内容
-            response_content = ""
-            if hasattr(anthropic_response, 'content') and anthropic_response.content:
+            if global_config.debug_log_enabled:
+                content_buffer = io.StringIO()
                 for content_block in anthropic_response.content:
                     if hasattr(content_block, 'text'):
-                        response_content += content_block.text
-            
-            global_config.add_debug_log(
-                "response",
-                f"Anthropic messages response: {request.model}",
-                {
-                    "response_id": getattr(anthropic_response, 'id', 'unknown'),
-                    "model": request.model,
-                    "usage": getattr(anthropic_response, 'usage', None).__dict__ if hasattr(anthropic_response, 'usage') else None,
-                    "content": response_content,
-                    "stop_reason": getattr(anthropic_response, 'stop_reason', None),
-                    "full_response": {
-                        "id": getattr(anthropic_response, 'id', 'unknown'),
-                        "type": getattr(anthropic_response, 'type', 'message'),
-                        "role": getattr(anthropic_response, 'role', 'assistant'),
-                        "content": [{"type": "text", "text": response_content}] if response_content else [],
-                        "model": getattr(anthropic_response, 'model', request.model),
-                        "stop_reason": getattr(anthropic_response, 'stop_reason', None),
-                        "usage": getattr(anthropic_response, 'usage', None).__dict__ if hasattr(anthropic_response, 'usage') else None
+                        content_buffer.write(content_block.text)
+                response_content = content_buffer.getvalue()
+                
+                global_config.add_debug_log(
+                    "response",
+                    f"Anthropic messages response: {served_request.model}",
+                    {
+                        "response_id": anthropic_response.id or 'unknown',
+                        "model": served_request.model,
+                        "usage": anthropic_response.usage.__dict__,
+                        "content": response_content,
+                        "stop_reason": anthropic_response.stop_reason
                     }
-                }
-            )
+                )
             
             return anthropic_response
                 
@@ -2073,56 +2223,43 @@ async def create_message(
             "traceback": error_traceback
         }
         
-        # Check for LiteLLM-specific attributes
-        for attr in ['message', 'status_code', 'response', 'llm_provider', 'model']:
+        # Check for LiteLLM-specific attributes (some are class attributes or properties,
+        # so they are read with getattr rather than from the instance dict)
+        for attr in ('message', 'status_code', 'response', 'llm_provider', 'model'):
             if hasattr(e, attr):
                 error_details[attr] = getattr(e, attr)
         
-        # Check for additional exception details in dictionaries
-        if hasattr(e, '__dict__'):
-            for key, value in e.__dict__.items():
-                if key not in error_details and key not in ['args', '__traceback__']:
-                    error_details[key] = str(value)
-        
-        # Helper function to safely serialize objects for JSON
-        def sanitize_for_json(obj):
-            """递归地清理对象使其可以JSON序列化"""
-            if isinstance(obj, dict):
-                return {k: sanitize_for_json(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [sanitize_for_json(item) for item in obj]
-            elif hasattr(obj, '__dict__'):
-                return sanitize_for_json(obj.__dict__)
-            elif hasattr(obj, 'text'):
-                return str(obj.text)
-            else:
-                try:
-                    json.dumps(obj)
-                    return obj
-                except (TypeError, ValueError):
-                    return str(obj)
+        # Any other instance attributes are stringified
+        for key, value in vars(e).items():
+            if key not in error_details and key not in ('args', '__traceback__'):
+                error_details[key] = str(value)
         
         # Log all error details with safe serialization
         sanitized_details = sanitize_for_json(error_details)
-        logger.error(f"Error processing request: {json.dumps(sanitized_details, indent=2)}")
+        try:
+            error_json = orjson.dumps(sanitized_details, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # orjson rejects integers beyond 64 bits; the stdlib encoder accepts them
+            error_json = json.dumps(sanitized_details, indent=2, default=str)
+        logger.error(f"Error processing request: {error_json}")
         
         # 记录调试日志 - 包含完整错误详情
-        global_config.add_debug_log(
-            "error",
-            f"Request processing error: {type(e).__name__}",
-            {
-                "error_type": type(e).__name__,
-                "error_message": str(e),
-                "model": getattr(request, 'model', 'unknown'),
-                "full_error_details": sanitized_details,
-                "request_summary": {
-                    "model": getattr(request, 'model', 'unknown'),
-                    "messages_count": len(getattr(request, 'messages', [])),
-                    "stream": getattr(request, 'stream', False),
-                    "max_tokens": getattr(request, 'max_tokens', None)
+        if global_config.debug_log_enabled:
+            global_config.add_debug_log(
+                "error",
+                f"Request processing error: {type(e).__name__}",
+                {
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                    "full_error_details": sanitized_details,
+                    "request_summary": {
+                        "model": request.model,
+                        "messages_count": len(request.messages),
+                        "stream": request.stream,
+                        "max_tokens": request.max_tokens
+                    }
                 }
-            }
-        )
+            )
         
         # Format error for response
         error_message = f"Error: {str(e)}"
@@ -2135,6 +2272,31 @@ async def create_message(
         status_code = error_details.get('status_code', 500)
         raise HTTPException(status_code=status_code, detail=error_message)
 
+def _token_counter_args(request: TokenCountRequest) -> Dict[str, Any]:
+    """Convert a token count request into keyword arguments for litellm's token_counter."""
+    converted_request = convert_anthropic_to_litellm(
+        MessagesRequest(
+            model=request.model,
+            max_tokens=100,  # Arbitrary value not used for token counting
+            messages=request.messages,
+            system=request.system,
+            tools=request.tools,
+            tool_choice=request.tool_choice,
+            thinking=request.thinking
+        )
+    )
+    
+    token_counter_args = {
+        "model": converted_request["model"],
+        "messages": converted_request["messages"],
+    }
+    
+    # Add custom base URL for OpenAI models if configured
+    if request.model.startswith("openai/") and OPENAI_BASE_URL:
+        token_counter_args["api_base"] = OPENAI_BASE_URL
+    
+    return token_counter_args
+
 @app.post("/v1/messages/count_tokens")
 async def count_tokens(
     request: TokenCountRequest,
@@ -2150,29 +2312,10 @@ async def count_tokens(
         original_model = request.original_model or request.model
         
         # Get the display name for logging, just the model name without provider prefix
-        display_model = original_model
-        if "/" in display_model:
-            display_model = display_model.split("/")[-1]
-        
-        # Clean model name for capability check
-        clean_model = request.model
-        if clean_model.startswith("anthropic/"):
-            clean_model = clean_model[len("anthropic/"):]
-        elif clean_model.startswith("openai/"):
-            clean_model = clean_model[len("openai/"):]
+        display_model = display_model_name(original_model)
         
         # Convert the messages to a format LiteLLM can understand
-        converted_request = convert_anthropic_to_litellm(
-            MessagesRequest(
-                model=request.model,
-                max_tokens=100,  # Arbitrary value not used for token counting
-                messages=request.messages,
-                system=request.system,
-                tools=request.tools,
-                tool_choice=request.tool_choice,
-                thinking=request.thinking
-            )
-        )
+        token_counter_args = _token_counter_args(request)
         
         # Use LiteLLM's token_counter function
         try:
@@ -2186,24 +2329,15 @@ async def count_tokens(
                 "POST",
                 raw_request.url.path,
                 display_model,
-                converted_request.get('model'),
-                len(converted_request['messages']),
+                token_counter_args["model"],
+                len(token_counter_args["messages"]),
                 num_tools,
                 200  # Assuming success at this point
             )
             
-            # Prepare token counter arguments
-            token_counter_args = {
-                "model": converted_request["model"],
-                "messages": converted_request["messages"],
-            }
-            
-            # Add custom base URL for OpenAI models if configured
-            if request.model.startswith("openai/") and OPENAI_BASE_URL:
-                token_counter_args["api_base"] = OPENAI_BASE_URL
-            
             # Count tokens
-            token_count = token_counter(**token_counter_args)
+            # Tokenization is CPU-bound; run it on a worker thread so the event loop stays responsive
+            token_count = await asyncio.to_thread(token_counter, **token_counter_args)
             
             # Return Anthropic-style response
             return TokenCountResponse(input_tokens=token_count)
@@ -2219,6 +2353,37 @@ async def count_tokens(
         logger.error(f"Error counting tokens: {str(e)}\n{error_traceback}")
         raise HTTPException(status_code=500, detail=f"Error counting tokens: {str(e)}")
 
+@app.post("/v1/messages/count_tokens:batch")
+async def count_tokens_batch(
+    request: BatchTokenCountRequest,
+    raw_request: Request
+):
+    """Count tokens for several requests in one call; results are returned in item order.
+    
+    Counting is always done locally with LiteLLM, also in transparent mode, because the
+    Anthropic API has no batch counterpart to forward to.
+    """
+    try:
+        from litellm import token_counter
+        
+        def count_all() -> List[TokenCountResponse]:
+            return [
+                TokenCountResponse(input_tokens=token_counter(**_token_counter_args(item)))
+                for item in request.items
+            ]
+        
+        # Tokenize the whole batch in one worker-thread hop so the event loop stays responsive
+        results = await asyncio.to_thread(count_all)
+        
+        logger.debug(f"Counted tokens for {len(results)} batched requests")
+        return BatchTokenCountResponse(results=results)
+            
+    except Exception as e:
+        import traceback
+        error_traceback = traceback.format_exc()
+        logger.error(f"Error counting tokens: {str(e)}\n{error_traceback}")
+        raise HTTPException(status_code=500, detail=f"Error counting tokens: {str(e)}")
+
 @app.get("/")
 async def root():
     return {"message": "Anthropic Proxy for LiteLLM"}
@@ -2271,12 +2436,10 @@ async def switch_model(request: ConfigUpdateRequest):
             raise HTTPException(status_code=400, detail="Invalid provider. Must be one of: openai, google, anthropic")
         
         # 验证模型（现在支持所有三个提供商的模型）
-        all_models = OPENAI_MODELS + GEMINI_MODELS + ANTHROPIC_MODELS
-        
-        if request.big_model and request.big_model not in all_models:
+        if request.big_model and request.big_model not in _ALL_MODELS:
             logger.warning(f"Big model '{request.big_model}' not in known model lists")
         
-        if request.small_model and request.small_model not in all_models:
+        if request.small_model and request.small_model not in _ALL_MODELS:
             logger.warning(f"Small model '{request.small_model}' not in known model lists")
         
         # 更新配置
@@ -2476,44 +2639,33 @@ class Colors:
     BOLD = "\033[1m"
     UNDERLINE = "\033[4m"
     DIM = "\033[2m"
+# Precomputed console templates for log_request_beautifully
+_REQUEST_LOG_TEMPLATE = (
+    f"{Colors.BOLD}{{method}} {{endpoint}}{Colors.RESET} {{status}}\n"
+    f"{Colors.CYAN}{{claude_model}}{Colors.RESET} → {Colors.GREEN}{{openai_model}}{Colors.RESET} "
+    f"{Colors.MAGENTA}{{num_tools}} tools{Colors.RESET} {Colors.BLUE}{{num_messages}} messages{Colors.RESET}\n"
+)
+_STATUS_OK_TEMPLATE = f"{Colors.GREEN}✓ {{}} OK{Colors.RESET}"
+_STATUS_ERROR_TEMPLATE = f"{Colors.RED}✗ {{}}{Colors.RESET}"
+
 def log_request_beautifully(method, path, claude_model, openai_model, num_messages, num_tools, status_code):
     """Log requests in a beautiful, twitter-friendly format showing Claude to OpenAI mapping."""
-    # 检查是否应该显示控制台日志（可通过环境变量控制）
-    import os
-    show_console_logs = os.getenv("CLAUDE_PROXY_CONSOLE_LOGS", "true").lower() == "true"
-    
-    if not show_console_logs:
+    # 检查是否应该显示控制台日志（可通过环境变量控制；交互式终端会在运行时切换，因此每次读取）
+    if os.environ.get("CLAUDE_PROXY_CONSOLE_LOGS", "true").lower() != "true":
         return  # 不显示控制台日志
     
-    # Format the Claude model name nicely
-    claude_display = f"{Colors.CYAN}{claude_model}{Colors.RESET}"
-    
-    # Extract endpoint name
-    endpoint = path
-    if "?" in endpoint:
-        endpoint = endpoint.split("?")[0]
-    
-    # Extract just the OpenAI model name without provider prefix
-    openai_display = openai_model
-    if "/" in openai_display:
-        openai_display = openai_display.split("/")[-1]
-    openai_display = f"{Colors.GREEN}{openai_display}{Colors.RESET}"
-    
-    # Format tools and messages
-    tools_str = f"{Colors.MAGENTA}{num_tools} tools{Colors.RESET}"
-    messages_str = f"{Colors.BLUE}{num_messages} messages{Colors.RESET}"
-    
-    # Format status code
-    status_str = f"{Colors.GREEN}✓ {status_code} OK{Colors.RESET}" if status_code == 200 else f"{Colors.RED}✗ {status_code}{Colors.RESET}"
-    
-
-    # Put it all together in a clear, beautiful format
-    log_line = f"{Colors.BOLD}{method} {endpoint}{Colors.RESET} {status_str}"
-    model_line = f"{claude_display} → {openai_display} {tools_str} {messages_str}"
+    status_template = _STATUS_OK_TEMPLATE if status_code == 200 else _STATUS_ERROR_TEMPLATE
     
-    # Print to console
-    print(log_line)
-    print(model_line)
+    # Write both lines at once: endpoint without query string, OpenAI model without provider prefix
+    sys.stdout.write(_REQUEST_LOG_TEMPLATE.format(
+        method=method,
+        endpoint=path.partition("?")[0],
+        status=status_template.format(status_code),
+        claude_model=claude_model,
+        openai_model=display_model_name(openai_model),
+        num_tools=num_tools,
+        num_messages=num_messages,
+    ))
     sys.stdout.flush()
 
 # OpenAI兼容接口 - 用于Claude Code
@@ -2533,44 +2685,41 @@ async def openai_chat_completions(request: OpenAIChatRequest, raw_request: Reque
     """OpenAI兼容的chat completions接口，专门用于Claude Code"""
     try:
         # 记录调试日志 - 包含完整请求内容
-        messages_content = []
-        for msg in request.messages:
-            messages_content.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-        
-        global_config.add_debug_log(
-            "request",
-            f"OpenAI chat completions request: {request.model}",
-            {
-                "model": request.model,
-                "messages_count": len(request.messages),
-                "messages": messages_content,  # 完整消息内容
-                "stream": request.stream,
-                "temperature": request.temperature,
-                "max_tokens": request.max_tokens,
-                "full_request": {
+        if global_config.debug_log_enabled:
+            messages_content = []
+            for msg in request.messages:
+                messages_content.append({
+                    "role": msg.role,
+                    "content": msg.content
+                })
+            
+            global_config.add_debug_log(
+                "request",
+                f"OpenAI chat completions request: {request.model}",
+                {
                     "model": request.model,
-                    "messages": messages_content,
+                    "messages_count": len(request.messages),
+                    "stream": request.stream,
                     "temperature": request.temperature,
                     "max_tokens": request.max_tokens,
-                    "stream": request.stream,
-                    "top_p": getattr(request, 'top_p', None),
-                    "frequency_penalty": getattr(request, 'frequency_penalty', None),
-                    "presence_penalty": getattr(request, 'presence_penalty', None),
-                    "stop": getattr(request, 'stop', None)
+                    "full_request": {
+                        "messages": messages_content,  # 完整消息内容
+                        "top_p": getattr(request, 'top_p', None),
+                        "frequency_penalty": getattr(request, 'frequency_penalty', None),
+                        "presence_penalty": getattr(request, 'presence_penalty', None),
+                        "stop": getattr(request, 'stop', None)
+                    }
                 }
-            }
-        )
+            )
         
-        # 转换为Anthropic格式的消息
-        anthropic_messages = []
-        for msg in request.messages:
-            anthropic_messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        # 转换为Anthropic格式的消息：OpenAIMessage 已校验 content 为字符串，直接构造 Message 跳过重复校验
+        # （Pydantic 不会重新校验已构造的模型实例；其他角色仍以字典传入，由 MessagesRequest 校验并报错）
+        anthropic_messages = [
+            Message.model_construct(role=msg.role, content=msg.content)
+            if msg.role in ("user", "assistant")
+            else {"role": msg.role, "content": msg.content}
+            for msg in request.messages
+        ]
         
         # 创建Anthropic请求
         anthropic_request = MessagesRequest(
@@ -2593,7 +2742,7 @@ async def openai_chat_completions(request: OpenAIChatRequest, raw_request: Reque
             openai_response = {
                 "id": f"chatcmpl-{response.id}",
                 "object": "chat.completion",
-                "created": int(time.time()),
+                "created": _Clock.now(),
                 "model": request.model,
                 "choices": [{
                     "index": 0,
@@ -2611,34 +2760,37 @@ async def openai_chat_completions(request: OpenAIChatRequest, raw_request: Reque
             }
             
             # 记录调试日志 - 包含完整响应内容
-            global_config.add_debug_log(
-                "response",
-                f"OpenAI chat completions response: {request.model}",
-                {
-                    "response_id": openai_response["id"],
-                    "model": request.model,
-                    "finish_reason": "stop",
-                    "usage": openai_response["usage"],
-                    "content": openai_response["choices"][0]["message"]["content"],  # 完整响应内容
-                    "full_response": openai_response  # 完整响应对象
-                }
-            )
+            if global_config.debug_log_enabled:
+                global_config.add_debug_log(
+                    "response",
+                    f"OpenAI chat completions response: {request.model}",
+                    {
+                        "response_id": openai_response["id"],
+                        "model": request.model,
+                        "finish_reason": "stop",
+                        "usage": openai_response["usage"],
+                        "content": openai_response["choices"][0]["message"]["content"],  # 完整响应内容
+                        "full_response": openai_response  # 完整响应对象（与返回体共用同一个字典，不复制）
+                    }
+                )
             
-            return openai_response
+            # 直接用 orjson 序列化一次并返回字节，跳过 FastAPI 的 jsonable_encoder 遍历
+            return Response(content=orjson.dumps(openai_response), media_type="application/json")
         else:
             return response
             
     except Exception as e:
         # 记录错误日志
-        global_config.add_debug_log(
-            "error",
-            f"OpenAI chat completions error: {str(e)}",
-            {
-                "model": request.model,
-                "error": str(e),
-                "messages_count": len(request.messages)
-            }
-        )
+        if global_config.debug_log_enabled:
+            global_config.add_debug_log(
+                "error",
+                f"OpenAI chat completions error: {str(e)}",
+                {
+                    "model": request.model,
+                    "error": str(e),
+                    "messages_count": len(request.messages)
+                }
+            )
         raise e
 
 if __name__ == "__main__":
@@ -2647,5 +2799,7 @@ if __name__ == "__main__":
         print("Run with: uvicorn server:app --reload --host 0.0.0.0 --port 8082")
         sys.exit(0)
     
-    # Configure uvicorn to run with minimal logs
-    uvicorn.run(app, host="0.0.0.0", port=8082, log_level="error")
+    # Configure uvicorn to run with minimal logs and no access log. Its default loop/http
+    # settings already use uvloop and httptools when installed (fastapi[standard]). Keep a
+    # single worker: the model configuration, debug logs and conversation buffer live in this process.
+    uvicorn.run(app, host="0.0.0.0", port=8082, log_level="error", access_log=False)